@@ -3,8 +3,15 @@ __credits__ = ["Nathan Kirk"]
 __license__ = "GPL-3.0 license"
 __email__ = "nkirk@westmont.edu"
 
+from array import array
+from bisect import bisect_left
 from math import sqrt, log10
+import heapq
+import pickle
+import random
 import sys
+import time
+import uuid
 from typing import Callable, Iterable
 import concurrent.futures
 
@@ -78,7 +85,11 @@ class Vector:
         elif other is None or not isinstance(other, Vector):
             return False
         else:
-            return self._vec == other.vec
+            # Compares the values, not the storage, so vectors of different precisions can be compared.
+            return list(self) == list(other)
+
+    def __iter__(self):
+        return iter(self._vec)
 
     def __str__(self) -> str:
         return str(self._vec)
@@ -126,24 +137,91 @@ class Vector:
         if not isinstance(other, Vector):
             raise ValueError(self._get_cannot_compute_msg("boolean intersection", other))
         else:
-            return [(e1, e2) for e1, e2 in zip(self._vec, other._vec) if e1 and e2]
+            return [(e1, e2) for e1, e2 in zip(self, other) if e1 and e2]
+
+
+class QuantizedVector(Vector):
+    """A vector stored as signed 8-bit codes and a scale per element, element i is `codes[i] * scales[i]`. The scales
+    are shared by every vector of a TF-IDF matrix (one per term), so each weight only takes a single byte. Setting an
+    element only accepts values within the range of its term's scale (up to 127 times the scale either way).
+     codes: array('b'), scales: array('f')"""
+
+    def __init__(self, codes, scales):
+        super().__init__(codes)
+        self._scales = scales
+
+    def __getitem__(self, index: int) -> float:
+        return super().__getitem__(index) * self._scales[index]
+
+    def __setitem__(self, index: int, element: float) -> None:
+        if not 0 <= index < len(self._vec):
+            raise IndexError(f"Index out of range: {index}")
+        scale = self._scales[index]
+        if abs(element) > 127 * scale * (1 + 1e-6) or (element and not scale):
+            raise ValueError(f"Cannot store {element} at index {index}, the scale of the term allows up to "
+                             f"{127 * scale} either way")
+        super().__setitem__(index, QuantizedVector.quantize(element, scale))
+
+    def __iter__(self):
+        return (code * scale for code, scale in zip(self._vec, self._scales))
+
+    def __str__(self) -> str:
+        return str(list(self))
+
+    @property
+    def scales(self):
+        return self._scales
+
+    @staticmethod
+    def quantize(element: float, scale: float) -> int:
+        """Returns the 8-bit code of `element` for the given `scale`."""
+        return max(-127, min(127, round(element / scale))) if scale else 0
+
+    def norm(self) -> float:
+        """Euclidean norm of the vector, computed on the codes."""
+        sum1 = 0
+        for code, scale in zip(self._vec, self._scales):
+            if code:
+                sum1 += (code * scale) ** 2
+        return sqrt(sum1)
+
+    def dot(self, other: object) -> float:
+        """Dot product of `self` and `other` vectors, computed on the codes."""
+        if not isinstance(other, Vector):
+            raise ValueError(self._get_cannot_compute_msg("dot product", other))
+        else:
+            sum1 = 0
+            for code, scale, element in zip(self._vec, self._scales, other):
+                if code:
+                    sum1 += code * scale * element
+            return sum1
 
 
 class Corpus:
     """A corpus is a list of documents. This class does the TF-IDF calculations and makes the matrix of vector values
-     documents: list[Document]"""
+     documents: list[Document]
 
-    def __init__(self, documents, threads=1, debug=False):
+    The weights of the matrix are stored with the given `precision`: "float64" (a list of Python floats per document),
+    "float32" (an `array('f')` per document) or "int8" (8-bit codes with one scale per term, see `QuantizedVector`).
+    Use `precision_report` to check how much the compact precisions change the rankings."""
+    PRECISIONS = ("float64", "float32", "int8")
+
+    def __init__(self, documents, threads=1, debug=False, precision="float64"):
         self._docs: list[Document] = documents
 
         # Setting flags.
         self._threads: int = threads
         self._debug: bool = debug
+        self._precision: str = Corpus._check_precision(precision)
 
         # Bulk of the processing (and runtime) occurs here.
         self._terms = self._compute_terms()
         self._dfs = self._compute_dfs()
         self._tf_idf = self._compute_tf_idf_matrix()
+        if precision == "int8":
+            self._tf_idf = self._convert_matrix(self._tf_idf, precision)
+        self._suggester = None
+        self._lsh_index = None
 
     def __getitem__(self, index) -> Document:
         if 0 <= index < len(self._docs):
@@ -173,6 +251,84 @@ class Corpus:
     def tf_idf(self):
         return self._tf_idf
 
+    @property
+    def suggester(self):
+        # Corpora pickled before spelling suggestions were added have none.
+        return getattr(self, "_suggester", None)
+
+    def build_suggester(self, max_distance=2, prefix_length=7) -> "TermSuggester":
+        """Builds and returns the spelling suggestion index of this corpus. It is kept on the corpus, so it is pickled
+        along with it and only needs to be built once."""
+        self._suggester = TermSuggester(self, max_distance, prefix_length)
+        return self._suggester
+
+    @property
+    def lsh_index(self):
+        # Corpora pickled before LSH indexes were added have none.
+        return getattr(self, "_lsh_index", None)
+
+    def build_lsh_index(self, num_bits=4, num_tables=8, seed=None) -> "RandomProjectionIndex":
+        """Builds and returns the approximate "more like this video" index of this corpus. It is kept on the corpus,
+        so it is pickled along with it and only needs to be rebuilt for other settings."""
+        self._lsh_index = RandomProjectionIndex(self, num_bits, num_tables, seed)
+        return self._lsh_index
+
+    @property
+    def precision(self):
+        # Corpora pickled before precisions were added are float64.
+        return getattr(self, "_precision", "float64")
+
+    def set_precision(self, precision: str) -> None:
+        """Converts the TF-IDF matrix to `precision`. Precision lost by an earlier conversion is not recovered."""
+        self._tf_idf = self._convert_matrix(self._tf_idf, Corpus._check_precision(precision))
+        self._precision = precision
+
+    def precision_report(self, precision: str, num_results: int = 10, sample_size: int = 100, seed=None) -> dict:
+        """Compares the rankings of the current TF-IDF matrix with those of the matrix converted to `precision`.
+
+        Like the runner, each query is a single term of the corpus, chosen at random.
+
+        Args:
+            precision (str): the precision to check.
+            num_results (int): number of top results compared per query.
+            sample_size (int): number of queries, all terms if None.
+            seed: seed for choosing the queries.
+
+        Returns:
+            A dictionary with the number of `queries`, the mean top-k `overlap` (fraction of the current top-k
+            results, ignoring scores of zero or less, found in the converted top-k), the fraction of queries with an
+            `identical` top-k in the same order, and the `max_score_error` over all scores.
+
+        """
+        converted = self._convert_matrix(self._tf_idf, Corpus._check_precision(precision))
+        terms = list(self._terms)
+        if sample_size is not None and sample_size < len(terms):
+            terms = random.Random(seed).sample(terms, sample_size)
+
+        overlap = identical = max_score_error = 0.0
+        for term in terms:
+            query_document = Document("query", {"title": "", "description": "", "channel": "", "tags": [term]})
+            query_vector = self.compute_tf_idf_vector(query_document)
+            rankings = []
+            for matrix in (self._tf_idf, converted):
+                scores = {title: vector.cossim(query_vector) for title, vector in matrix.items()}
+                top = heapq.nlargest(num_results, scores.items(), key=lambda item: item[1])
+                rankings.append(([title for title, score in top if score > 0], scores))
+            (reference, reference_scores), (compact, compact_scores) = rankings
+
+            overlap += len(set(reference) & set(compact)) / len(reference) if reference else 1.0
+            identical += reference == compact
+            max_score_error = max(max_score_error, max(abs(reference_scores[title] - compact_scores[title])
+                                                       for title in reference_scores))
+
+        queries = len(terms)
+        return {
+            "queries": queries,
+            "overlap": overlap / queries if queries else 0.0,
+            "identical": identical / queries if queries else 0.0,
+            "max_score_error": max_score_error,
+        }
+
     def _compute_terms(self) -> dict:
         """Computes and returns the terms (unique, stemmed, and filtered words) of the corpus."""
         list1 = []
@@ -241,6 +397,9 @@ class Corpus:
                 print(f"Processing '{document.title}'")
                 sys.stdout.flush()
             vector = self.compute_tf_idf_vector(doc=document)
+            # Compact precisions never hold the float64 weights of more than one document at a time.
+            if self.precision != "float64":
+                vector = Vector(array("f", vector))
             return vector
 
         matrix = {}
@@ -297,7 +456,549 @@ class Corpus:
                     print(f"Key '{key}' generated exception:", e, file=sys.stderr)
         return result
 
+    def _convert_matrix(self, matrix: dict, precision: str) -> dict:
+        """Returns a copy of the TF-IDF `matrix` with its weights stored in `precision`.
+        dict[str, Vector]"""
+        if precision == "float64":
+            return {title: Vector(list(vector)) for title, vector in matrix.items()}
+        elif precision == "float32":
+            return {title: Vector(array("f", vector)) for title, vector in matrix.items()}
+
+        # One scale per term, so that the largest weight of the term in any document maps to 127.
+        scales = array("f", bytes(4 * len(self._terms)))
+        for vector in matrix.values():
+            for index, element in enumerate(vector):
+                if abs(element) > scales[index]:
+                    scales[index] = abs(element)
+        for index, largest in enumerate(scales):
+            scales[index] = largest / 127
+        return {title: QuantizedVector(array("b", [QuantizedVector.quantize(x, scale)
+                                                   for x, scale in zip(vector, scales)]), scales)
+                for title, vector in matrix.items()}
+
+    @staticmethod
+    def _check_precision(precision: str) -> str:
+        """A helper function to validate the `precision` argument."""
+        if precision not in Corpus.PRECISIONS:
+            raise ValueError(f"Precision must be one of {', '.join(Corpus.PRECISIONS)}: {precision}")
+        return precision
+
     @staticmethod
     def _build_index_dict(lst: list) -> dict:
         """Given a list, returns a dictionary of {item from list: index of item}."""
         return {item: index for (index, item) in enumerate(lst)}
+
+
+class RandomProjectionIndex:
+    """Approximate nearest neighbor index over the TF-IDF matrix of a corpus, used for "more like this video" queries.
+
+    Each of the `num_tables` tables hashes a document vector to a `num_bits` signature with signed random projections
+    (every term gets a random +1/-1 weight per bit, the bit is set when the weighted sum is positive). Documents that
+    share a signature with the query in any table become candidates, and only the candidates are scored with the exact
+    cosine similarity. More bits make smaller buckets (faster, lower recall), more tables give true neighbors more
+    chances to collide (higher recall, slower).
+     corpus: Corpus"""
+
+    def __init__(self, corpus, num_bits=4, num_tables=8, seed=None):
+        if not 1 <= num_bits <= 64:
+            raise ValueError(f"num_bits must be between 1 and 64: {num_bits}")
+        if num_tables < 1:
+            raise ValueError(f"num_tables must be at least 1: {num_tables}")
+        self._corpus = corpus
+        self._num_bits = num_bits
+        self._num_tables = num_tables
+
+        # One random word per term and table, bit b of the word is the sign of the term on hyperplane b.
+        rng = random.Random(seed)
+        self._term_bits = [array("Q", (rng.getrandbits(num_bits) for _ in range(len(corpus.terms))))
+                           for _ in range(num_tables)]
+
+        self._buckets: list[dict[int, list[str]]] = [{} for _ in range(num_tables)]
+        for title, vector in corpus.tf_idf.items():
+            for table, signature in enumerate(self._signatures(vector)):
+                self._buckets[table].setdefault(signature, []).append(title)
+
+    @property
+    def num_bits(self):
+        return self._num_bits
+
+    @property
+    def num_tables(self):
+        return self._num_tables
+
+    def _signatures(self, vector: Vector) -> list:
+        """Computes and returns the signature of `vector` in every table.
+        list[int]"""
+        nonzero = [(index, weight) for index, weight in enumerate(vector) if weight]
+        signatures = []
+        for term_bits in self._term_bits:
+            sums = [0.0] * self._num_bits
+            for index, weight in nonzero:
+                bits = term_bits[index]
+                for bit in range(self._num_bits):
+                    sums[bit] += weight if bits >> bit & 1 else -weight
+            signatures.append(sum(1 << bit for bit, total in enumerate(sums) if total > 0))
+        return signatures
+
+    def _get_vector(self, title: str) -> Vector:
+        """A helper function to fetch the TF-IDF vector of the document titled `title`."""
+        try:
+            return self._corpus.tf_idf[title]
+        except KeyError:
+            raise ValueError(f"No document titled: {title}") from None
+
+    def candidates(self, vector: Vector) -> set:
+        """Returns the titles of all documents sharing a bucket with `vector` in at least one table.
+        set[str]"""
+        result = set()
+        for table, signature in enumerate(self._signatures(vector)):
+            result.update(self._buckets[table].get(signature, ()))
+        return result
+
+    def score(self, vector: Vector, titles) -> dict:
+        """Returns the cosine similarity between `vector` and each document titled in `titles`.
+        dict[str, float]"""
+        return {title: self._corpus.tf_idf[title].cossim(vector) for title in titles}
+
+    def similar(self, title: str, num_results: int = 10) -> list:
+        """Returns up to `num_results` (title, cosine similarity) pairs of the candidates most similar to the document
+        titled `title`, best first. The document itself is excluded.
+
+        Same as `candidates`, then `score`, then keeping the best scores, which callers may also do step by step.
+        list[tuple[str, float]]"""
+        query_vector = self._get_vector(title)
+        scores = self.score(query_vector, self.candidates(query_vector) - {title})
+        return heapq.nlargest(num_results, scores.items(), key=lambda item: item[1])
+
+    def exact_similar(self, title: str, num_results: int = 10) -> list:
+        """Same as `similar` but scores every document in the corpus, used as the ground truth for recall.
+        list[tuple[str, float]]"""
+        query_vector = self._get_vector(title)
+        scores = [(other, vector.cossim(query_vector))
+                  for other, vector in self._corpus.tf_idf.items() if other != title]
+        return sorted(scores, key=lambda item: item[1], reverse=True)[:num_results]
+
+    def recall_report(self, num_results: int = 10, sample_size: int = None, seed=None) -> dict:
+        """Compares `similar` against `exact_similar` using documents of the corpus as queries.
+
+        Args:
+            num_results (int): the k in recall@k.
+            sample_size (int): number of documents to use as queries, all documents if None.
+            seed: seed for choosing the sample.
+
+        Returns:
+            A dictionary with the number of `queries`, the mean `recall` (fraction of the exact top-k found by the
+            approximate search, ignoring exact results with a similarity of zero or less), the mean
+            `candidate_fraction` (share of the corpus scored per query) and the total `approximate_seconds` and
+            `exact_seconds` spent searching.
+
+        """
+        titles = list(self._corpus.tf_idf)
+        others = max(len(titles) - 1, 1)
+        if sample_size is not None and sample_size < len(titles):
+            titles = random.Random(seed).sample(titles, sample_size)
+
+        recall = candidate_fraction = approximate_seconds = exact_seconds = 0.0
+        for title in titles:
+            start = time.perf_counter()
+            approximate = self.similar(title, num_results)
+            approximate_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            exact = self.exact_similar(title, num_results)
+            exact_seconds += time.perf_counter() - start
+            # Documents without any similarity are arbitrary ties, not neighbors worth finding.
+            exact = [(t, score) for t, score in exact if score > 0]
+
+            if exact:
+                recall += len({t for t, _ in approximate} & {t for t, _ in exact}) / len(exact)
+            else:
+                recall += 1.0
+            candidate_fraction += len(self.candidates(self._get_vector(title)) - {title}) / others
+
+        queries = len(titles)
+        return {
+            "queries": queries,
+            "recall": recall / queries if queries else 0.0,
+            "candidate_fraction": candidate_fraction / queries if queries else 0.0,
+            "approximate_seconds": approximate_seconds,
+            "exact_seconds": exact_seconds,
+        }
+
+
+class TermSuggester:
+    """Spelling correction and suggestions for query terms using symmetric deletes (SymSpell) over a corpus' terms.
+
+    Every term is indexed under each string obtained by deleting up to `max_distance` characters from its first
+    `prefix_length` characters. A lookup only generates the deletes of the query's prefix, so its cost depends on the
+    length of the query and not on the size of the vocabulary. Candidates are verified with the real edit distance and
+    ranked by distance, then by document frequency. Suggestions that replace the whole word are never returned.
+
+    Most deletes belong to a single term, so a bucket holds the term itself and only becomes a list once shared.
+     corpus: Corpus"""
+
+    def __init__(self, corpus, max_distance=2, prefix_length=7):
+        if max_distance < 0:
+            raise ValueError(f"max_distance must not be negative: {max_distance}")
+        if prefix_length <= max_distance:
+            raise ValueError(f"prefix_length must be greater than max_distance: {prefix_length}")
+        self._max_distance = max_distance
+        self._prefix_length = prefix_length
+        self._dfs = corpus.dfs
+
+        self._deletes: dict[str, str | list[str]] = {}
+        for term in corpus.terms:
+            for delete in self._compute_deletes(term[:prefix_length]):
+                bucket = self._deletes.get(delete)
+                if bucket is None:
+                    self._deletes[delete] = term
+                elif isinstance(bucket, str):
+                    self._deletes[delete] = [bucket, term]
+                else:
+                    bucket.append(term)
+
+    @property
+    def max_distance(self):
+        return self._max_distance
+
+    def _compute_deletes(self, word: str) -> set:
+        """Computes and returns `word` and every string obtained by deleting up to `max_distance` characters from it.
+        set[str]"""
+        deletes = {word}
+        edits = [word]
+        for _ in range(self._max_distance):
+            next_edits = []
+            for edit in edits:
+                for i in range(len(edit)):
+                    delete = edit[:i] + edit[i + 1:]
+                    if delete not in deletes:
+                        deletes.add(delete)
+                        next_edits.append(delete)
+            edits = next_edits
+        return deletes
+
+    def suggest(self, word: str, num_results: int = 5) -> list:
+        """Returns up to `num_results` (term, edit distance, document frequency) suggestions for `word`, best first.
+
+        A term of the corpus is returned alone with a distance of 0, a blank `word` gets no suggestions.
+        list[tuple[str, int, int]]"""
+        if word in self._dfs:
+            return [(word, 0, self._dfs[word])]
+        if not word.strip():
+            return []
+
+        # A term needs no more deletes than its distance to `word` on either side, so deletes are visited by
+        # increasing number of deleted characters and the bound tightens once `num_results` closer suggestions exist.
+        prefix = word[:self._prefix_length]
+        # Rewriting every character of `word` is not a correction.
+        max_distance = min(self._max_distance, len(word) - 1)
+        counts = [0] * (max_distance + 1)
+        suggestions = []
+        checked = set()
+        for delete in sorted(self._compute_deletes(prefix), key=len, reverse=True):
+            if len(prefix) - len(delete) > max_distance:
+                break
+            bucket = self._deletes.get(delete, ())
+            for term in (bucket,) if isinstance(bucket, str) else bucket:
+                if term in checked or len(term[:self._prefix_length]) - len(delete) > max_distance:
+                    continue
+                checked.add(term)
+                if abs(len(term) - len(word)) > max_distance:
+                    continue
+                distance = TermSuggester._edit_distance(word, term, max_distance)
+                if distance <= max_distance:
+                    suggestions.append((term, distance, self._dfs[term]))
+                    counts[distance] += 1
+                    while max_distance and sum(counts[:max_distance]) >= num_results:
+                        max_distance -= 1
+        suggestions = [suggestion for suggestion in suggestions if suggestion[1] <= max_distance]
+        suggestions.sort(key=lambda item: (item[1], -item[2], item[0]))
+        return suggestions[:num_results]
+
+    def correct(self, word: str) -> str:
+        """Returns the best suggestion for `word`, or `word` itself if there is none."""
+        suggestions = self.suggest(word, 1)
+        return suggestions[0][0] if suggestions else word
+
+    @staticmethod
+    def _edit_distance(word1: str, word2: str, max_distance: int) -> int:
+        """Optimal string alignment distance (Levenshtein plus adjacent transpositions) between `word1` and `word2`.
+
+        Only cells within `max_distance` of the diagonal are computed, and `max_distance + 1` is returned as soon as
+        the distance is known to exceed `max_distance`.
+
+        """
+        # Common prefixes and suffixes do not change the distance.
+        len1, len2 = len(word1), len(word2)
+        while len1 and len2 and word1[len1 - 1] == word2[len2 - 1]:
+            len1 -= 1
+            len2 -= 1
+        start = 0
+        while start < len1 and start < len2 and word1[start] == word2[start]:
+            start += 1
+        word1, word2 = word1[start:len1], word2[start:len2]
+        len1, len2 = len1 - start, len2 - start
+
+        too_far = max_distance + 1
+        if not len1 or not len2 or abs(len1 - len2) > max_distance:
+            return min(max(len1, len2), too_far)
+
+        previous2 = None
+        previous = [j if j <= max_distance else too_far for j in range(len2 + 1)]
+        for i in range(1, len1 + 1):
+            current = [too_far] * (len2 + 1)
+            if i <= max_distance:
+                current[0] = i
+            row_min = current[0]
+            for j in range(max(1, i - max_distance), min(len2, i + max_distance) + 1):
+                cost = 0 if word1[i - 1] == word2[j - 1] else 1
+                distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+                if i > 1 and j > 1 and word1[i - 1] == word2[j - 2] and word1[i - 2] == word2[j - 1]:
+                    distance = min(distance, previous2[j - 2] + 1)
+                current[j] = min(distance, too_far)
+                row_min = min(row_min, current[j])
+            if row_min > max_distance:
+                return too_far
+            previous2, previous = previous, current
+        return previous[-1]
+
+
+class Vocabulary:
+    """A term dictionary shared by many indexes. Terms are interned and given integer ids in the order they are first
+    added, so ids never change and every index built against the same vocabulary agrees on them.
+
+    A pickled vocabulary and the one it was saved from can grow apart, giving the same ids to different terms. Ids are
+    therefore kept in segments with their own uid, and a new segment starts whenever a vocabulary is unpickled. An
+    index records the segment and size of the vocabulary it was built against (see `snapshot` and `covers`)."""
+
+    def __init__(self):
+        self._segments: list[tuple[str, int]] = [(uuid.uuid4().hex, 0)]  # [(uid, first term id)]
+        self._ids: dict[str, int] = {}
+        self._terms: list[str] = []
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # This copy grows independently of the vocabulary it was saved from, so the ids it adds get a new uid.
+        self._segments.append((uuid.uuid4().hex, len(self._terms)))
+
+    def __getitem__(self, term_id: int) -> str:
+        if 0 <= term_id < len(self._terms):
+            return self._terms[term_id]
+        else:
+            raise IndexError(f"Index out of range: {term_id}")
+
+    def __contains__(self, term: str) -> bool:
+        return term in self._ids
+
+    def __len__(self):
+        return len(self._terms)
+
+    def snapshot(self) -> tuple:
+        """Returns (uid of the segment holding the newest term, number of terms), identifying the current ids.
+        tuple[str, int]"""
+        size = len(self._terms)
+        for uid, start in reversed(self._segments):
+            if start < size or not start:
+                return uid, size
+
+    def covers(self, snapshot: tuple) -> bool:
+        """Returns whether every id of `snapshot` (see `snapshot`) still belongs to the same term in this vocabulary."""
+        uid, size = snapshot
+        for i, (segment_uid, start) in enumerate(self._segments):
+            if segment_uid == uid:
+                end = self._segments[i + 1][1] if i + 1 < len(self._segments) else len(self._terms)
+                return start <= size <= end
+        return False
+
+    def add(self, term: str) -> int:
+        """Returns the id of `term`, adding it to the vocabulary if it is new."""
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term_id = len(self._terms)
+            term = sys.intern(term)
+            self._ids[term] = term_id
+            self._terms.append(term)
+        return term_id
+
+    def get(self, term: str):
+        """Returns the id of `term`, or None if it is not in the vocabulary."""
+        return self._ids.get(term)
+
+
+class PostingsIndex:
+    """TF-IDF index over the documents of one user that stores integer postings against a shared `Vocabulary` instead
+    of a term dictionary and dense vectors of its own. Scores match `Corpus` (same TF-IDF weights, cosine similarity).
+
+    Postings are kept in flat typed arrays: the sorted ids of the terms in the index, and for the term at position p
+    the document indexes and weights between `_offsets[p]` and `_offsets[p + 1]`.
+     documents: list[Document], vocabulary: Vocabulary"""
+
+    def __init__(self, documents, vocabulary):
+        self._vocabulary = vocabulary
+        self._titles: list[str] = [doc.title for doc in documents]
+
+        postings: dict[int, list[tuple[int, int]]] = {}
+        for doc_index, doc in enumerate(documents):
+            tfs = {}
+            for word in doc.words:
+                term_id = vocabulary.add(word)
+                tfs[term_id] = tfs.get(term_id, 0) + 1
+            for term_id, tf in tfs.items():
+                postings.setdefault(term_id, []).append((doc_index, tf))
+
+        self._term_ids = array("I", sorted(postings))
+        self._offsets = array("I", [0])
+        self._doc_indexes = array("I")
+        self._weights = array("d")
+        squared_norms = [0.0] * len(documents)
+        for term_id in self._term_ids:
+            df = len(postings[term_id])
+            for doc_index, tf in postings[term_id]:
+                weight = self._compute_tf_idf(tf, df)
+                self._doc_indexes.append(doc_index)
+                self._weights.append(weight)
+                squared_norms[doc_index] += weight * weight
+            self._offsets.append(len(self._doc_indexes))
+        self._norms = array("d", [sqrt(x) for x in squared_norms])
+        self._vocabulary_snapshot = vocabulary.snapshot()
+
+    def __getstate__(self):
+        # The vocabulary is shared, it is saved once by its owner and reattached on load.
+        state = self.__dict__.copy()
+        state["_vocabulary"] = None
+        return state
+
+    def __len__(self):
+        return len(self._titles)
+
+    @property
+    def titles(self):
+        return self._titles
+
+    @property
+    def vocabulary(self):
+        return self._vocabulary
+
+    def attach(self, vocabulary: Vocabulary) -> None:
+        """Attaches the shared `vocabulary` this index was built against, e.g. after unpickling."""
+        if len(vocabulary) < self._vocabulary_snapshot[1]:
+            raise ValueError("Index uses terms that are not in this vocabulary, it may be an older copy")
+        if not vocabulary.covers(self._vocabulary_snapshot):
+            raise ValueError("Index was built against a different vocabulary")
+        self._vocabulary = vocabulary
+
+    def _find(self, term_id: int) -> int:
+        """Returns the position of `term_id` in `_term_ids`, or -1 if the term does not occur in this index."""
+        position = bisect_left(self._term_ids, term_id)
+        if position < len(self._term_ids) and self._term_ids[position] == term_id:
+            return position
+        return -1
+
+    def _compute_tf_idf(self, tf: int, df: int) -> float:
+        """Computes and returns the TF-IDF score of a term, same as `Corpus._compute_tf_idf`."""
+        return log10(1 + tf) * log10(len(self) / (1 + df))
+
+    def df(self, term_id: int) -> int:
+        """Returns the document frequency of the term with id `term_id` in this index."""
+        position = self._find(term_id)
+        return self._offsets[position + 1] - self._offsets[position] if position >= 0 else 0
+
+    def score(self, query_tfs: dict) -> dict:
+        """Returns the cosine similarity between a query and every document sharing a term with it.
+
+        Args:
+            query_tfs (dict): {term id: term frequency in the query}.
+
+        Returns:
+            A dictionary of {document index: cosine similarity}.
+
+        """
+        query_postings = []
+        squared_norm = 0.0
+        for term_id, tf in query_tfs.items():
+            position = self._find(term_id)
+            if position >= 0:
+                start, stop = self._offsets[position], self._offsets[position + 1]
+                query_weight = self._compute_tf_idf(tf, stop - start)
+                query_postings.append((query_weight, start, stop))
+                squared_norm += query_weight * query_weight
+        if not squared_norm:
+            return {}
+
+        dots = {}
+        for query_weight, start, stop in query_postings:
+            for i in range(start, stop):
+                doc_index = self._doc_indexes[i]
+                dots[doc_index] = dots.get(doc_index, 0.0) + query_weight * self._weights[i]
+        query_norm = sqrt(squared_norm)
+        return {doc_index: dot / (query_norm * self._norms[doc_index])
+                for doc_index, dot in dots.items() if self._norms[doc_index]}
+
+
+class IndexCollection:
+    """Many `PostingsIndex`es (e.g. one per user's watch history) sharing a single `Vocabulary`, so common terms are
+    stored once however many indexes use them and a query can be answered across all of them in one pass.
+     vocabulary: Vocabulary"""
+
+    def __init__(self, vocabulary=None):
+        self._vocabulary: Vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self._indexes: dict[str, PostingsIndex] = {}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for index in self._indexes.values():
+            index.attach(self._vocabulary)
+
+    def __getitem__(self, name: str) -> PostingsIndex:
+        return self._indexes[name]
+
+    def __iter__(self):
+        return iter(self._indexes)
+
+    def __len__(self):
+        return len(self._indexes)
+
+    @property
+    def vocabulary(self):
+        return self._vocabulary
+
+    def add(self, name: str, documents) -> PostingsIndex:
+        """Builds, stores and returns the index of `documents` under `name`, replacing any index with that name."""
+        index = PostingsIndex(documents, self._vocabulary)
+        self._indexes[name] = index
+        return index
+
+    def save(self, name: str, file) -> None:
+        """Pickles the index stored under `name` to the binary `file`, without the shared vocabulary."""
+        pickle.dump(self._indexes[name], file)
+
+    def load(self, name: str, file) -> PostingsIndex:
+        """Loads an index saved with `save` from the binary `file` and stores it under `name`.
+
+        The index must have been built against this collection's vocabulary (saved by pickling the collection).
+
+        """
+        index = pickle.load(file)
+        index.attach(self._vocabulary)
+        self._indexes[name] = index
+        return index
+
+    def search(self, words, num_results: int = 10, names=None) -> list:
+        """Searches the indexes named in `names` (all if None) for the query `words`.
+
+        Returns:
+            Up to `num_results` (index name, document title, cosine similarity) tuples, best first.
+
+        """
+        query_tfs = {}
+        for word in words:
+            term_id = self._vocabulary.get(word)
+            if term_id is not None:
+                query_tfs[term_id] = query_tfs.get(term_id, 0) + 1
+
+        results = []
+        for name in (names if names is not None else self._indexes):
+            index = self._indexes[name]
+            results.extend((name, index.titles[doc_index], score)
+                           for doc_index, score in index.score(query_tfs).items())
+        return heapq.nlargest(num_results, results, key=lambda item: item[2])
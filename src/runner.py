@@ -1,9 +1,14 @@
 import argparse
+from collections import deque
+import heapq
 import json
+import os
 import pickle
+import shutil
+import tempfile
 import time
 import sys
-from src.models import Corpus, Document
+from src.models import Corpus, Document, RandomProjectionIndex, TermSuggester
 
 
 from src.helper_functions import fetch_video_info
@@ -17,6 +22,12 @@ __email__ = "nkirk@westmont.edu"
 def main() -> None:
     pars = setup_argument_parser()
     args = pars.parse_args()
+    if args.precision_report and not args.precision:
+        pars.error("--precision-report requires --precision")
+    # Similar videos are scored exactly unless an LSH setting is given, the recall report always needs the index.
+    use_lsh = args.lsh_bits is not None or args.lsh_tables is not None or args.recall_report
+    lsh_bits = args.lsh_bits if args.lsh_bits is not None else 4
+    lsh_tables = args.lsh_tables if args.lsh_tables is not None else 8
     timer = Timer()
 
     try:
@@ -30,12 +41,70 @@ def main() -> None:
             for video in final_data:
                 videoDict = Document(None, video)
                 corpus_documents.append(videoDict)
-        corpus = timer.run_with_timer(Corpus, [corpus_documents, args.num_threads, args.debug],
+        # The report needs the float64 weights, so the corpus is converted after it.
+        precision = "float64" if args.precision_report else args.precision or "float64"
+        corpus = timer.run_with_timer(Corpus, [corpus_documents, args.num_threads, args.debug, precision],
                                       label="corpus instantiation (includes TF-IDF matrix)")
-        with open(args.pickle_file_path, "wb") as pickle_file:
-            pickle.dump(corpus, pickle_file)
+        if args.precision_report:
+            convert_precision(corpus, args.precision, timer, report=True)
+        if not args.no_spelling:
+            timer.run_with_timer(corpus.build_suggester, label="spelling index build")
+        if use_lsh:
+            timer.run_with_timer(corpus.build_lsh_index, [lsh_bits, lsh_tables], label="LSH index build")
+        save_corpus(corpus, args.pickle_file_path)
+    else:
+        changed = False
+        if not args.no_spelling and corpus.suggester is None:
+            # The pickle predates the spelling index, it is built once and saved with the corpus for the next runs.
+            timer.run_with_timer(corpus.build_suggester, label="spelling index build")
+            changed = True
+        index = corpus.lsh_index
+        if use_lsh and (index is None or (index.num_bits, index.num_tables) != (lsh_bits, lsh_tables)):
+            timer.run_with_timer(corpus.build_lsh_index, [lsh_bits, lsh_tables], label="LSH index build")
+            changed = True
+        if changed:
+            save_corpus(corpus, args.pickle_file_path)
+        # The pickle file keeps its weights, converting them only reduces memory while running.
+        if args.precision and (args.precision != corpus.precision or args.precision_report):
+            convert_precision(corpus, args.precision, timer, report=args.precision_report)
 
-    keep_querying(corpus, 10)
+    index = corpus.lsh_index if use_lsh else None
+    if args.recall_report:
+        print_recall_report(index, 10, args.recall_sample)
+    if args.similar:
+        keep_finding_similar(corpus, index, 10, QueryProfiler(enabled=args.profile))
+        return
+
+    suggester = None if args.no_spelling else corpus.suggester
+    keep_querying(corpus, 10, suggester, QueryProfiler(enabled=args.profile))
+
+
+def save_corpus(corpus: Corpus, pickle_file_path: str) -> bool:
+    """Pickles `corpus` to a temporary file next to `pickle_file_path` and then replaces it, so an interrupted write never
+    leaves a broken pickle file behind. A pickle file that is not writable is left alone. Returns whether it was saved."""
+    # The write bits are checked too, `os.access` ignores them for the superuser.
+    if os.path.exists(pickle_file_path) and (not os.access(pickle_file_path, os.W_OK) or
+                                             not os.stat(pickle_file_path).st_mode & 0o222):
+        print(f"Warning: {pickle_file_path} is read-only, the corpus was not saved", file=sys.stderr)
+        return False
+
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(os.path.abspath(pickle_file_path)),
+                                         prefix=".", suffix=".tmp", delete=False) as temp_file:
+            temp_path = temp_file.name
+            pickle.dump(corpus, temp_file)
+        if os.path.exists(pickle_file_path):
+            shutil.copymode(pickle_file_path, temp_path)
+        os.replace(temp_path, pickle_file_path)
+        temp_path = None
+        return True
+    except OSError as e:
+        print(f"Warning: could not save the corpus to {pickle_file_path}: {e}", file=sys.stderr)
+        return False
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
 
 
 def setup_argument_parser() -> argparse.ArgumentParser:
@@ -46,36 +115,163 @@ def setup_argument_parser() -> argparse.ArgumentParser:
                       help="required string containing the path to a pickle (data) file")
     pars.add_argument("-d", "--debug", action="store_true",
                       help="flag to enable printing debug statements to console output")
+    pars.add_argument("-s", "--similar", action="store_true",
+                      help="flag to query by video title for similar videos, scored exactly against every video by "
+                           "default or with the approximate (LSH) index when --lsh-bits or --lsh-tables is given")
+    pars.add_argument("--lsh-bits", type=int,
+                      help="bits per LSH signature, more bits means smaller buckets (faster, lower recall); "
+                           "enables the LSH index for -s, 4 if only --lsh-tables is given")
+    pars.add_argument("--lsh-tables", type=int,
+                      help="number of LSH tables, more tables means higher recall (slower); "
+                           "enables the LSH index for -s, 8 if only --lsh-bits is given")
+    pars.add_argument("--recall-report", action="store_true",
+                      help="flag to print the recall of the LSH index (4 bits x 8 tables unless given) against exact "
+                           "search before querying")
+    pars.add_argument("--recall-sample", type=int, default=100,
+                      help="number of videos used as queries by --recall-report, 0 for all of them")
+    pars.add_argument("--no-spelling", action="store_true",
+                      help="flag to disable rewriting queries that are not in the corpus to the closest known term")
+    pars.add_argument("-p", "--profile", action="store_true",
+                      help="flag to start with the per query latency breakdown enabled")
+    pars.add_argument("--precision", choices=Corpus.PRECISIONS,
+                      help="store the TF-IDF weights as float64, float32 or 8-bit quantized (int8) values")
+    pars.add_argument("--precision-report", action="store_true",
+                      help="flag to print how rankings with --precision compare to the weights in the pickle file")
     return pars
 
 
-def keep_querying(corpus: Corpus, num_results: int) -> None:
+def keep_querying(corpus: Corpus, num_results: int, suggester: TermSuggester = None,
+                  profiler: "QueryProfiler" = None) -> None:
+    if profiler is None:
+        profiler = QueryProfiler()
     again_response = 'y'
 
     while again_response == 'y':
         raw_query = input("Your query? ")
+        if handle_profile_command(raw_query, profiler):
+            continue
+
+        profiler.start()
+        if suggester and raw_query.strip() and raw_query not in corpus.terms:
+            suggestions = suggester.suggest(raw_query)
+            if suggestions:
+                print(f"No results for '{raw_query}', showing results for '{suggestions[0][0]}'")
+                if len(suggestions) > 1:
+                    print("Did you mean: " + ", ".join(f"'{term}'" for term, _, _ in suggestions[1:]))
+                raw_query = suggestions[0][0]
         # puts the users query in the tags part of the doc
         query_document = Document("query", {"title": "", "description": "", "channel": "", "tags": [raw_query]})
         query_vector = corpus.compute_tf_idf_vector(query_document)
+        profiler.lap("analysis")
 
+        # Exact search has no candidate generation, every document is scored.
         query_result = {}
         for title, doc_vector in corpus.tf_idf.items():
             query_result[title] = doc_vector.cossim(query_vector)
+        profiler.lap("scoring")
+
+        ranked_result = rank_query_result(query_result, num_results)
+        profiler.lap("top-k")
+
+        display_query_result(raw_query, ranked_result)
+        profiler.lap("display")
+        profiler.print_last()
+
+        again_response = input("Again (y/N)? ").lower()
+
+
+def handle_profile_command(raw_query: str, profiler: "QueryProfiler") -> bool:
+    """Handles ':profile [on|off|reset]' typed as a query, returns whether `raw_query` was such a command."""
+    words = raw_query.split()
+    if not words or words[0] != ":profile":
+        return False
+
+    command = words[1] if len(words) > 1 else "report"
+    if command == "on":
+        profiler.enabled = True
+        print("Profiling enabled")
+    elif command == "off":
+        profiler.enabled = False
+        print("Profiling disabled")
+    elif command == "reset":
+        profiler.reset()
+        print("Profiling samples cleared")
+    else:
+        profiler.print_report()
+    return True
+
+
+def keep_finding_similar(corpus: Corpus, index: RandomProjectionIndex = None, num_results: int = 10,
+                         profiler: "QueryProfiler" = None) -> None:
+    if profiler is None:
+        profiler = QueryProfiler()
+    again_response = 'y'
+
+    while again_response == 'y':
+        title = input("Video title? ")
+        if handle_profile_command(title, profiler):
+            continue
+        if title not in corpus.tf_idf:
+            print(f"No video titled '{title}'\n")
+            again_response = input("Again (y/N)? ").lower()
+            continue
+
+        # Same steps as `RandomProjectionIndex.similar` (or `exact_similar` without an index), timed one by one.
+        profiler.start()
+        query_vector = corpus.tf_idf[title]
+        profiler.lap("analysis")
+
+        if index is not None:
+            candidates = index.candidates(query_vector) - {title}
+            profiler.lap("candidates")
+
+            query_result = index.score(query_vector, candidates)
+        else:
+            query_result = {other: vector.cossim(query_vector)
+                            for other, vector in corpus.tf_idf.items() if other != title}
+        profiler.lap("scoring")
+
+        ranked_result = rank_query_result(query_result, num_results)
+        profiler.lap("top-k")
+
+        display_query_result(title, ranked_result)
+        profiler.lap("display")
+        profiler.print_last()
 
-        display_query_result(raw_query, query_result, corpus, num_results)
         again_response = input("Again (y/N)? ").lower()
 
 
-def display_query_result(query: str, query_result: dict, corpus: Corpus, num_results) -> None:
-    if num_results > len(corpus):
-        num_results = len(corpus)
+def print_recall_report(index: RandomProjectionIndex, num_results: int, sample_size: int) -> None:
+    report = index.recall_report(num_results, sample_size if sample_size > 0 else None)
+    print(f"LSH ({index.num_bits} bits x {index.num_tables} tables) over {report['queries']} queries: "
+          f"recall@{num_results} {report['recall']:0.4f}, "
+          f"{report['candidate_fraction']:0.2%} of corpus scored per query, "
+          f"{report['approximate_seconds']:0.4f} vs {report['exact_seconds']:0.4f} seconds exact")
+
+
+def convert_precision(corpus: Corpus, precision: str, timer: "Timer", report: bool = False) -> None:
+    if report:
+        print_precision_report(corpus, precision, 10)
+    if precision != corpus.precision:
+        timer.run_with_timer(corpus.set_precision, [precision], label=f"conversion to {precision} weights")
+
+
+def print_precision_report(corpus: Corpus, precision: str, num_results: int) -> None:
+    report = corpus.precision_report(precision, num_results)
+    print(f"{precision} weights over {report['queries']} queries: "
+          f"top-{num_results} overlap {report['overlap']:0.4f}, "
+          f"identical rankings {report['identical']:0.2%}, "
+          f"max score error {report['max_score_error']:0.2e}")
 
-    sorted_result = sorted([(title, score) for title, score in query_result.items()],
-                           key=lambda item: item[1], reverse=True)
 
+def rank_query_result(query_result: dict, num_results: int) -> list:
+    """Returns the `num_results` best (title, score) pairs of `query_result`, best first."""
+    return heapq.nlargest(num_results, query_result.items(), key=lambda item: item[1])
+
+
+def display_query_result(query: str, ranked_result: list) -> None:
     print(f"\nFor query : {query}")
-    for i in range(num_results):
-        title, score = sorted_result[i]
+    for i, (title, score) in enumerate(ranked_result):
         print(f"Result {i + 1:02d} : [{score:0.6f}] {title}")
     print()
 
@@ -103,10 +299,89 @@ class Timer:
         return self._stop - self._start
 
     def start(self) -> None:
-        self._start = time.time()
+        self._start = time.perf_counter()
 
     def stop(self) -> None:
-        self._stop = time.time()
+        self._stop = time.perf_counter()
+
+
+class QueryProfiler:
+    """Per query latency breakdown by phase using the monotonic high resolution clock.
+
+    The last `window` samples of every phase are kept, so the report reflects the recent query mix. When disabled,
+    `start` and `lap` return right away. Phases a query does not go through (exact search has no candidate generation)
+    are left out of it.
+
+    """
+    PHASES = ("analysis", "candidates", "scoring", "top-k", "display")
+
+    def __init__(self, enabled=False, window=1000):
+        self.enabled = enabled
+        self._window = window
+        self._samples = {}
+        self._current = {}
+        self._last = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self._samples = {phase: deque(maxlen=self._window) for phase in self.PHASES + ("total",)}
+        self._current = {}
+
+    def start(self) -> None:
+        """Marks the start of a query."""
+        if self.enabled:
+            self._current = {}
+            self._last = time.perf_counter_ns()
+
+    def lap(self, phase: str) -> None:
+        """Records the time since the previous mark as `phase` of the current query."""
+        if self.enabled:
+            now = time.perf_counter_ns()
+            elapsed = now - self._last
+            self._samples[phase].append(elapsed)
+            self._current[phase] = elapsed
+            self._last = now
+            if phase == self.PHASES[-1]:
+                total = sum(self._current.values())
+                self._samples["total"].append(total)
+                self._current["total"] = total
+
+    def histogram(self, phase: str) -> list:
+        """Returns the recent samples of `phase` counted in power of two buckets of microseconds.
+        list[tuple[int, int]] of (bucket upper bound in microseconds, count)"""
+        counts = {}
+        for sample in self._samples[phase]:
+            bound = 1 << max(sample // 1000, 0).bit_length()
+            counts[bound] = counts.get(bound, 0) + 1
+        return sorted(counts.items())
+
+    def print_last(self, file=sys.stdout) -> None:
+        """Prints the phases of the last profiled query on one line."""
+        if self.enabled and "total" in self._current:
+            phases = ", ".join(f"{phase} {self._current[phase] / 1e6:0.3f}"
+                               for phase in self.PHASES if phase in self._current)
+            print(f"Query latency (ms): {phases}, total {self._current['total'] / 1e6:0.3f}\n", file=file)
+
+    def print_report(self, file=sys.stdout) -> None:
+        """Prints percentiles and a histogram of every phase over the recent queries."""
+        if not self._samples["total"]:
+            if self.enabled:
+                print("No profiled queries yet\n", file=file)
+            else:
+                print("No profiled queries yet, enable profiling with ':profile on'\n", file=file)
+            return
+
+        print(f"Latency over the last {len(self._samples['total'])} queries (ms):", file=file)
+        for phase in self.PHASES + ("total",):
+            samples = sorted(self._samples[phase])
+            if not samples:
+                continue
+            p50, p95, p99 = (samples[min(int(len(samples) * q), len(samples) - 1)] for q in (0.5, 0.95, 0.99))
+            print(f"  {phase:<10} mean {sum(samples) / len(samples) / 1e6:9.3f}  p50 {p50 / 1e6:9.3f}  "
+                  f"p95 {p95 / 1e6:9.3f}  p99 {p99 / 1e6:9.3f}  max {samples[-1] / 1e6:9.3f}", file=file)
+            for bound, count in self.histogram(phase):
+                print(f"    <{bound:>9} us {count:>5} {'#' * max(1, 40 * count // len(samples))}", file=file)
+        print(file=file)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,6 @@
+from array import array
+import io
+import pickle
 import unittest
 
 from nltk import PorterStemmer
@@ -7,6 +10,11 @@ from prototype import *
 from src.models import *
 
 
+def make_video(title, tags):
+    """Returns a document with only a title and tags, the rest of the content is empty."""
+    return Document(None, {"title": title, "description": "", "channel": "", "tags": tags})
+
+
 class TestVector(unittest.TestCase):
 
     def test_norm_empty_vector(self):
@@ -132,5 +140,248 @@ class TestCorpus(unittest.TestCase):
         self.assertTrue(self.corp._compute_tf_idf_matrix(), "Matrix returned false when it should be true")
 
 
+class TestRandomProjectionIndex(unittest.TestCase):
+    def setUp(self):
+        docs = [make_video("doc1", ["cod", "xbox", "mw2"]), make_video("doc2", ["cod", "xbox", "halo"]),
+                make_video("doc3", ["minecraft", "redstone"]),
+                make_video("doc4", ["minecraft", "survival", "redstone"]), make_video("doc5", ["cooking", "pasta"])]
+        self.corp = Corpus(docs)
+
+    def test_similar_scores_match_exact(self):
+        index = RandomProjectionIndex(self.corp, num_bits=4, num_tables=4, seed=1)
+        exact = dict(index.exact_similar("doc1", 4))
+        for title, score in index.similar("doc1", 4):
+            self.assertNotEqual(title, "doc1", "Query document should not be in its own results")
+            self.assertAlmostEqual(score, exact[title], delta=1e-9)
+
+    def test_one_bit_finds_nearest_neighbor(self):
+        # With a single bit and many tables nearly every document becomes a candidate.
+        index = RandomProjectionIndex(self.corp, num_bits=1, num_tables=16, seed=1)
+        self.assertEqual(index.similar("doc3", 1)[0][0], "doc4", "Did not find the nearest neighbor")
+
+    def test_recall_report(self):
+        index = RandomProjectionIndex(self.corp, num_bits=1, num_tables=16, seed=1)
+        report = index.recall_report(num_results=2)
+        self.assertEqual(report["queries"], 5)
+        self.assertEqual(report["recall"], 1.0, "Expected full recall with a single bit and many tables")
+        self.assertTrue(0.0 <= report["candidate_fraction"] <= 1.0)
+
+    def test_unknown_title(self):
+        index = RandomProjectionIndex(self.corp, seed=1)
+        with self.assertRaises(ValueError):
+            index.similar("not a video")
+
+    def test_index_pickled_with_corpus(self):
+        self.assertIsNone(self.corp.lsh_index)
+        index = self.corp.build_lsh_index(num_bits=2, num_tables=8, seed=1)
+        loaded = pickle.loads(pickle.dumps(self.corp))
+        self.assertEqual((loaded.lsh_index.num_bits, loaded.lsh_index.num_tables), (2, 8))
+        self.assertIs(loaded.lsh_index._corpus, loaded, "Index should point at the unpickled corpus")
+        self.assertEqual(loaded.lsh_index.similar("doc3", 2), index.similar("doc3", 2))
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            RandomProjectionIndex(self.corp, num_bits=0)
+        with self.assertRaises(ValueError):
+            RandomProjectionIndex(self.corp, num_tables=0)
+
+
+class TestTermSuggester(unittest.TestCase):
+    def setUp(self):
+        docs = [make_video("doc1", ["minecraft", "redstone"]), make_video("doc2", ["minecraft", "survival"]),
+                make_video("doc3", ["minecart", "rails", "a"])]
+        self.suggester = TermSuggester(Corpus(docs))
+
+    def test_known_term(self):
+        self.assertEqual(self.suggester.suggest("redstone"), [("redstone", 0, 1)])
+
+    def test_ranked_by_distance_then_df(self):
+        suggestions = self.suggester.suggest("minecrat")
+        self.assertEqual([term for term, _, _ in suggestions], ["minecraft", "minecart"],
+                         "Ties should go to the higher df")
+        self.assertEqual(self.suggester.correct("minecraf"), "minecraft", "Did not prefer the closest term")
+
+    def test_transposition(self):
+        self.assertEqual(self.suggester.suggest("survivla"), [("survival", 1, 1)])
+
+    def test_no_suggestion(self):
+        self.assertEqual(self.suggester.suggest("xyzzy"), [])
+        self.assertEqual(self.suggester.correct("xyzzy"), "xyzzy", "Expected the word back without suggestions")
+
+    def test_blank_word(self):
+        self.assertEqual(self.suggester.suggest(""), [])
+        self.assertEqual(self.suggester.suggest("  "), [])
+
+    def test_whole_word_replaced(self):
+        # "b" is one edit from "a", but replacing every character is not a correction.
+        self.assertEqual(self.suggester.suggest("b"), [])
+
+    def test_pickled_with_corpus(self):
+        corpus = Corpus([make_video("doc1", ["minecraft"])])
+        self.assertIsNone(corpus.suggester)
+        corpus.build_suggester()
+        corpus = pickle.loads(pickle.dumps(corpus))
+        self.assertEqual(corpus.suggester.correct("minecrat"), "minecraft")
+
+    def test_edit_distance(self):
+        self.assertEqual(TermSuggester._edit_distance("kitten", "sitting", 3), 3)
+        self.assertEqual(TermSuggester._edit_distance("kitten", "sitting", 2), 3, "Expected max_distance + 1")
+        self.assertEqual(TermSuggester._edit_distance("abcd", "acbd", 2), 1)
+
+
+class TestIndexCollection(unittest.TestCase):
+    def setUp(self):
+        self.user1 = [make_video("doc1", ["cod", "xbox"]), make_video("doc2", ["halo", "xbox"]),
+                      make_video("doc3", ["pasta"])]
+        self.user2 = [make_video("doc4", ["cod", "pc"]), make_video("doc5", ["minecraft"]),
+                      make_video("doc6", ["pasta", "pc"])]
+        self.collection = IndexCollection()
+        self.collection.add("user1", self.user1)
+        self.collection.add("user2", self.user2)
+
+    def test_shared_vocabulary(self):
+        vocabulary = self.collection.vocabulary
+        self.assertEqual(len(vocabulary), len({"doc1", "doc2", "doc3", "doc4", "doc5", "doc6", "cod", "xbox", "halo",
+                                               "pasta", "pc", "minecraft"}), "Shared terms should be added once")
+        self.assertEqual(vocabulary[vocabulary.get("cod")], "cod")
+        self.assertIsNone(vocabulary.get("not a term"))
+
+    def test_collections_share_vocabulary(self):
+        vocabulary = Vocabulary()
+        collection1, collection2 = IndexCollection(vocabulary), IndexCollection(vocabulary)
+        self.assertIs(collection1.vocabulary, vocabulary, "An empty vocabulary passed in should be used")
+        self.assertIs(collection2.vocabulary, vocabulary)
+
+        collection1.add("user1", self.user1)
+        collection2.add("user2", self.user2)
+        self.assertEqual(len(vocabulary), 12, "Terms of both collections should be added to the shared vocabulary once")
+        file = io.BytesIO()
+        collection2.save("user2", file)
+        file.seek(0)
+        collection1.load("user2", file)
+        self.assertEqual({(name, title) for name, title, _ in collection1.search(["pasta"])},
+                         {("user1", "doc3"), ("user2", "doc6")})
+
+    def test_scores_match_corpus(self):
+        corpus = Corpus(self.user1)
+        query_vector = corpus.compute_tf_idf_vector(Document("query", {"title": "", "description": "", "channel": "",
+                                                                       "tags": ["cod"]}))
+        results = self.collection.search(["cod"], names=["user1"])
+        self.assertEqual([title for _, title, _ in results], ["doc1"])
+        self.assertAlmostEqual(results[0][2], corpus.tf_idf["doc1"].cossim(query_vector), delta=1e-9)
+
+    def test_search_across_indexes(self):
+        results = self.collection.search(["pasta"])
+        self.assertEqual({(name, title) for name, title, _ in results}, {("user1", "doc3"), ("user2", "doc6")})
+
+    def test_save_and_load(self):
+        file = io.BytesIO()
+        self.collection.save("user2", file)
+        file.seek(0)
+        index = self.collection.load("copy", file)
+        self.assertIs(index.vocabulary, self.collection.vocabulary, "Loaded index should reuse the shared vocabulary")
+        self.assertEqual(self.collection.search(["minecraft"], names=["copy"])[0][1], "doc5")
+
+    def test_load_with_other_vocabulary(self):
+        file = io.BytesIO()
+        self.collection.save("user1", file)
+        file.seek(0)
+        with self.assertRaises(ValueError):
+            IndexCollection().load("user1", file)
+
+    def test_load_into_stale_vocabulary(self):
+        snapshot = pickle.dumps(self.collection)
+        self.collection.add("user3", [make_video("doc7", ["zelda"])])
+        file = io.BytesIO()
+        self.collection.save("user3", file)
+
+        # The older copy of the vocabulary does not have the ids of "doc7" and "zelda".
+        stale = pickle.loads(snapshot)
+        file.seek(0)
+        with self.assertRaises(ValueError):
+            stale.load("user3", file)
+
+        # Once the older copy has grown, the same ids belong to other terms.
+        stale.add("user4", [make_video("doc8", ["new"])])
+        file.seek(0)
+        with self.assertRaises(ValueError):
+            stale.load("user3", file)
+
+    def test_load_into_grown_vocabulary(self):
+        file = io.BytesIO()
+        self.collection.save("user1", file)
+        collection = pickle.loads(pickle.dumps(self.collection))
+        collection.add("user3", [make_video("doc7", ["zelda"])])
+        file.seek(0)
+        collection.load("copy", file)
+        self.assertEqual(collection.search(["halo"], names=["copy"])[0][1], "doc2")
+
+    def test_pickle_collection(self):
+        collection = pickle.loads(pickle.dumps(self.collection))
+        self.assertIs(collection["user1"].vocabulary, collection.vocabulary)
+        self.assertEqual(collection.search(["halo"])[0][:2], ("user1", "doc2"))
+
+
+class TestPrecision(unittest.TestCase):
+    def setUp(self):
+        self.docs = [make_video("doc1", ["cod", "xbox", "mw2", "cod"]), make_video("doc2", ["cod", "xbox", "halo"]),
+                     make_video("doc3", ["minecraft", "redstone"]),
+                     make_video("doc4", ["minecraft", "survival", "redstone"]),
+                     make_video("doc5", ["cooking", "pasta"])]
+        self.corp = Corpus(self.docs)
+
+    def test_float32(self):
+        corp = Corpus(self.docs, precision="float32")
+        self.assertEqual(corp.precision, "float32")
+        for title, vector in corp.tf_idf.items():
+            self.assertEqual(vector.vec.typecode, "f")
+            for x, y in zip(vector, self.corp.tf_idf[title]):
+                self.assertAlmostEqual(x, y, delta=1e-6)
+
+    def test_int8(self):
+        corp = Corpus(self.docs, precision="int8")
+        for title, vector in corp.tf_idf.items():
+            self.assertIsInstance(vector, QuantizedVector)
+            self.assertEqual(vector.vec.typecode, "b")
+            for x, y in zip(vector, self.corp.tf_idf[title]):
+                self.assertAlmostEqual(x, y, delta=max(abs(y), 1e-3) / 100)
+
+    def test_quantized_dot_matches_dequantized(self):
+        self.corp.set_precision("int8")
+        vec1, vec2 = self.corp.tf_idf["doc1"], self.corp.tf_idf["doc2"]
+        self.assertAlmostEqual(vec1.dot(vec2), compute_dot_product(list(vec1), list(vec2)), delta=1e-9)
+        self.assertAlmostEqual(vec1.norm(), compute_euclidean_norm(list(vec1)), delta=1e-9)
+
+    def test_quantized_setitem(self):
+        vec = QuantizedVector(array("b", [10, 0]), array("f", [0.5, 0.0]))
+        vec[0] = -63.5
+        self.assertEqual(vec.vec[0], -127)
+        with self.assertRaises(ValueError):
+            vec[0] = 64.0
+        with self.assertRaises(ValueError):
+            vec[1] = 0.1
+        with self.assertRaises(IndexError):
+            vec[2] = 0.0
+
+    def test_quantized_equality(self):
+        codes = array("b", [1, 2])
+        self.assertNotEqual(QuantizedVector(codes, array("f", [1.0, 1.0])),
+                            QuantizedVector(codes, array("f", [2.0, 1.0])))
+        self.assertEqual(QuantizedVector(codes, array("f", [1.0, 0.5])), Vector([1.0, 1.0]))
+
+    def test_precision_report(self):
+        for precision in ("float32", "int8"):
+            report = self.corp.precision_report(precision, num_results=3, sample_size=None)
+            self.assertEqual(report["queries"], len(self.corp.terms))
+            self.assertEqual(report["overlap"], 1.0, f"{precision} changed the top results")
+            self.assertLess(report["max_score_error"], 0.01)
+
+    def test_invalid_precision(self):
+        with self.assertRaises(ValueError):
+            Corpus(self.docs, precision="float16")
+        with self.assertRaises(ValueError):
+            self.corp.set_precision("int4")
+
+
 if __name__ == '__main__':
     unittest.main()